@@ -1,22 +1,110 @@
 #! /usr/bin/env python3.11
 import json
 import logging
+import os
 import re
-from argparse import ArgumentParser
+import shutil
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urljoin, urlparse
 
 from bs4 import BeautifulSoup
-from requests import Session, HTTPError
+from requests import RequestException, Response, Session, HTTPError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ChunkedEncodingError, ConnectionError as RequestsConnectionError, ContentDecodingError,
+    SSLError as RequestsSSLError)
+from requests_cache import CachedSession
+from urllib3.exceptions import (
+    DecodeError, HTTPError as Urllib3HTTPError, ProtocolError, ReadTimeoutError, SSLError)
+from urllib3.util import Retry
+
+CACHE_NAME = "future-epw-analysis"
+CACHE_EXPIRATION_SECONDS = 3600
+
+
+def response_is_html_page(response: Response) -> bool:
+    """
+    Evaluates if response corresponds to an HTML page (as opposed to a downloaded file).
+
+    Args:
+        response (Response): Response received for a request.
+
+    Returns:
+        bool: True if the response content type is HTML, False otherwise.
+    """
+    return response.headers.get("Content-Type", "").casefold().startswith("text/html")
+
+
+def create_session(pool_maxsize: int = 16, use_cache: bool = True) -> Session:
+    """
+    Creates a session whose connections are kept alive and reused across requests, retrying
+    requests that fail due to connection errors or transient server-side responses.
+
+    If <use_cache> is set, HTML pages (i.e., the pages where links are searched) are cached
+    in a SQLite database in the user cache directory for CACHE_EXPIRATION_SECONDS, so that
+    consecutive runs do not fetch them again. Downloaded files are never cached.
+
+    Args:
+        pool_maxsize (int, optional): Maximum number of connections kept in the pool for a
+            single host. Defaults to 16.
+        use_cache (bool, optional): Whether to cache HTML pages. Defaults to True.
+
+    Returns:
+        Session: Session with a pooled, retrying adapter mounted for HTTP and HTTPS.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False))
+    if use_cache:
+        session = CachedSession(
+            CACHE_NAME,
+            backend="sqlite",
+            use_cache_dir=True,
+            expire_after=CACHE_EXPIRATION_SECONDS,
+            allowable_methods=("GET",),
+            filter_fn=response_is_html_page)
+    else:
+        session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def filename_from_url(url: str) -> str:
+    """
+    Returns the name of the file a URL points to, i.e., the last segment of its path.
+
+    Args:
+        url (str): URL of the file.
+
+    Returns:
+        str: Name of the file, used when saving it to the output directory.
+    """
+    return urlparse(url).path.split("/")[-1]
 
 
 def download_file_in_chunks(
         session: Session, url: str, output_dir: str | Path,
-        chunk_size: int | None = 500*1024) -> Path:
+        chunk_size: int | None = 8*1024*1024) -> Path:
     """
     Downloads a file in chunks from a URL, saves it in the desired output directory
     and returns its path.
 
+    The content is copied straight from the underlying (decoded) raw response into the
+    file, avoiding the per-chunk generator overhead of iterating over the response. When
+    the size of the content is known in advance, the file is pre-allocated (where supported
+    by the platform). The content is saved to a temporary '.part' file, which is only moved
+    to its final name once the download is complete, and removed if the download fails.
+
     Args:
         session (Session): Established session for multiple requests.
         url (str): URL from where to download the file.
@@ -24,20 +112,77 @@ def download_file_in_chunks(
             where the downloaded file will be saved.
         chunk_size (int | None, optional): Size, in bytes, of the chunks used to download
             the file. If None, the content is downloaded at once.
-            Defaults to 500*1024 (500 kB).
+            Defaults to 8*1024*1024 (8 MiB).
+
+    Raises:
+        HTTPError: If the server responds with an error status.
+        ChunkedEncodingError | ConnectionError | ContentDecodingError | SSLError: (from
+        requests.exceptions) If the connection breaks while the content is being read
+        (including when less content than the Content-Length is received), translated from
+        the corresponding urllib3 exceptions (as in iter_content).
 
     Returns:
         Path: Absolute, normalized path to the downloaded file (symlinks are resolved).
     """
-    path_to_downloaded_file = Path(output_dir, urlparse(url).path.split("/")[-1])
+    path_to_downloaded_file = Path(output_dir, filename_from_url(url))
+    path_to_partial_file = path_to_downloaded_file.with_name(
+        f"{path_to_downloaded_file.name}.part")
     with session.get(url, stream=True) as response:
         response.raise_for_status()
-        with open(path_to_downloaded_file, "wb") as file:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                file.write(chunk)
+        response.raw.decode_content = True
+        # with content encoding, Content-Length refers to the encoded content instead
+        content_length = response.headers.get("Content-Length", "")
+        expected_size = (
+            int(content_length)
+            if content_length.isdigit() and "Content-Encoding" not in response.headers
+            else 0)
+        try:
+            with open(path_to_partial_file, "wb") as file:
+                if expected_size and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(file.fileno(), 0, expected_size)
+                    except OSError as e:
+                        logging.debug(
+                            f"Could not pre-allocate '{path_to_partial_file.name}'. "
+                            f"Details: {str(e)}")
+                try:
+                    if chunk_size is None:
+                        file.write(response.raw.read())
+                    else:
+                        shutil.copyfileobj(response.raw, file, length=chunk_size)
+                except ProtocolError as e:
+                    raise ChunkedEncodingError(e) from e
+                except DecodeError as e:
+                    raise ContentDecodingError(e) from e
+                except ReadTimeoutError as e:
+                    raise RequestsConnectionError(e) from e
+                except SSLError as e:
+                    raise RequestsSSLError(e) from e
+                # urllib3 already fails on short content, this only guards against keeping
+                # pre-allocated space if the content length is not enforced
+                file.truncate()
+            os.replace(path_to_partial_file, path_to_downloaded_file)
+        except BaseException:
+            path_to_partial_file.unlink(missing_ok=True)
+            raise
     return path_to_downloaded_file.resolve()
 
 
+@lru_cache(maxsize=32)
+def compile_suffix_pattern(search_suffix: str) -> re.Pattern:
+    """
+    Compiles (once per suffix) a case-insensitive pattern that matches strings ending with
+    the provided suffix.
+
+    Args:
+        search_suffix (str): Suffix to be matched literally.
+
+    Returns:
+        re.Pattern: Compiled pattern for the suffix.
+    """
+    return re.compile(fr"{re.escape(search_suffix)}$", flags=re.IGNORECASE)
+
+
 def find_links_by_suffix(session: Session, url: str, search_suffix: str) -> list[str]:
     """
     Finds all <a> tags that have the desired suffix in the HTML markup from the provided
@@ -54,11 +199,10 @@ def find_links_by_suffix(session: Session, url: str, search_suffix: str) -> list
     """
     response = session.get(url)
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
+    soup = BeautifulSoup(response.content, "lxml")
 
     links = []
-    for link in soup.find_all("a", href=re.compile(
-            fr"{re.escape(search_suffix)}$", flags=re.IGNORECASE)):
+    for link in soup.find_all("a", href=compile_suffix_pattern(search_suffix)):
         links.append(link["href"])
     logging.info(
         f"Found {len(links)} link(s) in '{url}' matching the suffix '{search_suffix}'")
@@ -67,11 +211,12 @@ def find_links_by_suffix(session: Session, url: str, search_suffix: str) -> list
 
 def find_links_and_download_files(
         session: Session, url: str, search_suffix: str, output_dir: str | Path,
-        limit: int, start_at: int = 1) -> None:
+        limit: int, start_at: int = 1, concurrency: int = 8) -> None:
     """
     Find all links in a web page that have a specific suffix, then proceeds to download the
-    files from such links (in the order the links are present in the HTML markup), saving
-    them in a specified output directory.
+    files from such links (in the order the links are present in the HTML markup, with up to
+    <concurrency> downloads in progress at once), saving them in a specified output
+    directory.
 
     Args:
         session (Session): Established session for multiple requests.
@@ -82,6 +227,8 @@ def find_links_and_download_files(
         limit (int): Maximum number of files to download.
         start_at (int): From which link to start, considering link indices start at 1 in a
             list ordered by order of appearance in the HTML markdown. Defaults to 1.
+        concurrency (int): Maximum number of files downloaded at the same time, sharing the
+            connection pool from <session>. Defaults to 8.
 
     Raises:
         ValueError: If <start_at> is greater than the total amount of links found in the
@@ -98,33 +245,52 @@ def find_links_and_download_files(
         raise ValueError(
             f"There are less available links (={len(relative_download_links)}) than "
             f"the desired start position (={start_at})")
+    window = relative_download_links[start_at-1:start_at-1+limit]
     logging.info(
         f"Will download content from link(s) #{start_at} to "
-        f"#{min(start_at+len(relative_download_links), start_at+limit-1)} (inclusive)")
+        f"#{start_at+len(window)-1} (inclusive)")
 
     output_path = Path(output_dir)
     output_path.mkdir(exist_ok=True)
 
-    count = 0
-    for index, relative_link in enumerate(relative_download_links):
-        if index + 1 < start_at:
-            logging.debug(f"Ignoring link #{index+1}")
-            continue
-        if index + 1 >= start_at + limit:
-            logging.warning(f"Reached limit of {limit} downloaded file(s), exiting")
-            break
-
-        download_link = urljoin(url, relative_link)
-        logging.info(
-            f"({start_at+count}/{len(relative_download_links)}) Downloading from "
-            f"'{download_link}'")
-        count += 1
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        filenames = set()
+        for position, relative_link in enumerate(window, start=start_at):
+            download_link = urljoin(url, relative_link)
+            filename = filename_from_url(download_link)
+            if filename in filenames:
+                logging.warning(
+                    f"({position}/{len(relative_download_links)}) Skipping "
+                    f"'{download_link}', since another link is already being downloaded "
+                    f"to '{filename}'")
+                continue
+            filenames.add(filename)
+            futures[executor.submit(
+                download_file_in_chunks, session, download_link, output_path)] = (
+                    position, download_link)
         try:
-            download_file_in_chunks(session, download_link, output_path)
-        except HTTPError as e:
-            logging.exception(
-                f"Something went wrong when attempting to download file from "
-                f"'{download_link}'. Details: {str(e)}")
+            for future in as_completed(futures):
+                position, download_link = futures[future]
+                try:
+                    path_to_downloaded_file = future.result()
+                except (RequestException, Urllib3HTTPError) as e:
+                    logging.exception(
+                        f"Something went wrong when attempting to download file from "
+                        f"'{download_link}'. Details: {str(e)}")
+                    continue
+                logging.info(
+                    f"({position}/{len(relative_download_links)}) Downloaded "
+                    f"'{path_to_downloaded_file.name}' from '{download_link}'")
+        except KeyboardInterrupt:
+            logging.warning(
+                "Operation interrupted by the user, cancelling pending download(s) and "
+                "waiting for the ones in progress")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if start_at - 1 + len(window) < len(relative_download_links):
+        logging.warning(f"Reached limit of {limit} downloaded file(s), exiting")
 
 
 def load_json_conf(path_to_json: str | Path) -> list[dict[str, str]]:
@@ -157,6 +323,29 @@ def load_json_conf(path_to_json: str | Path) -> list[dict[str, str]]:
     return config.get("sources", [])
 
 
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument as an integer greater than or equal to 1.
+
+    Args:
+        value (str): Value provided in the command line.
+
+    Raises:
+        ArgumentTypeError: If the value is not an integer greater than or equal to 1.
+
+    Returns:
+        int: Parsed value.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(
+            f"must be an integer greater than or equal to 1, got '{value}'")
+    return number
+
+
 def main(args):
     logging.basicConfig(
         format="%(asctime)s    %(levelname)-8.8s: %(message)s",
@@ -173,17 +362,19 @@ def main(args):
         return
 
     if args.json_only:
-        link_details = []
-        with Session() as session:
-            for source in source_list:
-                link_details.append(
-                    {
-                        "url": source["website_url"],
-                        "search_suffix": source["search_suffix"],
-                        "download_links": [(i+1, link) for i, link in enumerate(
-                            find_links_by_suffix(
-                                session, source["website_url"], source["search_suffix"]))]
-                    })
+        with create_session(
+                pool_maxsize=args.concurrency, use_cache=not args.no_cache) as session, \
+                ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            found_links = executor.map(
+                lambda source: find_links_by_suffix(
+                    session, source["website_url"], source["search_suffix"]),
+                source_list)
+            link_details = [
+                {
+                    "url": source["website_url"],
+                    "search_suffix": source["search_suffix"],
+                    "download_links": [(i+1, link) for i, link in enumerate(links)]
+                } for source, links in zip(source_list, found_links)]
         output_json = Path("out.json")
         with open(output_json, "w") as file:
             json.dump(link_details, file, indent=2)
@@ -193,7 +384,8 @@ def main(args):
         return
 
     source_index = args.source_position - 1
-    with Session() as session:
+    with create_session(
+            pool_maxsize=args.concurrency, use_cache=not args.no_cache) as session:
         try:
             find_links_and_download_files(
                 session,
@@ -201,7 +393,8 @@ def main(args):
                 source_list[source_index]["search_suffix"],
                 output_path,
                 limit=args.limit,
-                start_at=args.start)
+                start_at=args.start,
+                concurrency=args.concurrency)
         except Exception as e:
             logging.exception(
                 f"Could not complete processing of files with given parameters. "
@@ -237,4 +430,12 @@ if __name__ == "__main__":
         help="from which source (in config file) to collect files, considering indices "
         "start at 1. Optional arguments are only related to the source selected here. "
         "Ignored if --json-only is passed. Defaults to 1")
+    parser.add_argument(
+        "-c", "--concurrency", type=positive_int, default=8,
+        help="maximum number of files downloaded (or source pages searched, if "
+        "--json-only is passed) at the same time. Defaults to 8")
+    parser.add_argument(
+        "--no-cache", action="store_true", dest="no_cache",
+        help="always fetch the source pages, instead of reusing the ones cached (for "
+        f"{CACHE_EXPIRATION_SECONDS}s) in previous runs")
     main(parser.parse_args())
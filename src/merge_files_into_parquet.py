@@ -1,5 +1,6 @@
 #! /usr/bin/env python3.11
 import logging
+import os
 import statistics
 import time
 from argparse import ArgumentParser
@@ -60,8 +61,10 @@ def list_epw_files(directory: Path) -> list[Path]:
     Returns:
         list[Path]: List of Path objects for each EPW file found in the directory.
     """
-    epw_file_collection = [
-        file for file in directory.iterdir() if file.suffix.casefold() == ".epw".casefold()]
+    with os.scandir(directory) as entries:
+        epw_file_collection = [
+            Path(entry.path) for entry in entries
+            if entry.name.lower().endswith(".epw") and entry.is_file()]
     if not epw_file_collection:
         logging.warning("No EPW files found in the selected path")
         raise ValueError("Selected path contains no EPW files.")
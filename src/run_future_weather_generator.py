@@ -1,8 +1,12 @@
 #! /usr/bin/env python3.11
 import logging
+import os
+import re
 import subprocess
+import threading
 import time
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 # Future Weather Generator parameters, for version 1.4.0
@@ -28,6 +32,20 @@ DO_LIMIT_VARIABLES = "true"
 SOLAR_HOUR_ADJUSTMENT = 2       # by day
 DIFFUSE_IRRADIATION_MODEL = 1   # Engerer (2015)
 
+# JVM tuning for long-running batch jobs
+JVM_OPTIONS = [
+    "-XX:+UseParallelGC",
+    "-XX:+UseNUMA",
+    "-XX:-UsePerfData",
+]
+# dynamic class data sharing archives (-XX:ArchiveClassesAtExit) require JDK 13+
+MIN_JAVA_VERSION_FOR_DYNAMIC_CDS = 13
+
+# Morph processes currently running, so that they can be terminated if the run is cancelled
+_running_processes: set[subprocess.Popen] = set()
+_running_processes_lock = threading.Lock()
+_cancelled = threading.Event()
+
 
 def list_epw_files(directory: Path) -> list[Path]:
     """
@@ -42,8 +60,10 @@ def list_epw_files(directory: Path) -> list[Path]:
     Returns:
         list[Path]: List of Path objects for each EPW file found in the directory.
     """
-    epw_file_collection = [
-        file for file in directory.iterdir() if file.suffix.casefold() == ".epw".casefold()]
+    with os.scandir(directory) as entries:
+        epw_file_collection = [
+            Path(entry.path) for entry in entries
+            if entry.name.lower().endswith(".epw") and entry.is_file()]
     if not epw_file_collection:
         logging.warning("No EPW files found in the selected path")
         raise ValueError("Selected path contains no EPW files.")
@@ -53,6 +73,193 @@ def list_epw_files(directory: Path) -> list[Path]:
     return epw_file_collection
 
 
+def get_java_feature_version() -> int | None:
+    """
+    Returns the feature (major) version of the available Java runtime, e.g. 8 for
+    "1.8.0_301" or 17 for "17.0.2".
+
+    Returns:
+        int | None: Feature version of the Java runtime, or None if it could not be
+        determined.
+    """
+    try:
+        result = subprocess.run(
+            ["java", "-version"], capture_output=True, text=True, errors="replace")
+    except OSError:
+        return None
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', result.stderr)
+    if not match:
+        return None
+    major, minor = match.groups()
+    return int(minor) if major == "1" and minor else int(major)
+
+
+def build_morph_command(
+        path_to_jar: Path, output_path: Path,
+        jvm_options: list[str] = JVM_OPTIONS) -> tuple[list[str], list[str]]:
+    """
+    Builds the command used to execute the Future Weather Generator (Morph), with all the
+    arguments that are shared by every EPW file, split into the arguments that go before
+    and after the EPW file argument, which is added for each file.
+
+    Args:
+        path_to_jar (Path): Path to the Future Weather Generator jar file.
+        output_path (Path): Directory where the generated EPW files will be saved.
+        jvm_options (list[str], optional): Options passed to the JVM.
+            Defaults to JVM_OPTIONS.
+
+    Returns:
+        tuple[list[str], list[str]]: Command arguments before and after the EPW file
+        argument.
+    """
+    return [
+        "java",
+        *jvm_options,
+        "-cp",
+        str(path_to_jar.resolve()),
+        "futureweathergenerator.Morph",
+    ], [
+        ",".join(GCM_MODELS),
+        str(ENSEMBLE),
+        str(MONTH_TRANSITION_HOURS),
+        str(output_path.resolve()) + "/",
+        MULTITHREAD_COMPUTATION,
+        str(INTERPOLATION_METHOD_ID),
+        DO_LIMIT_VARIABLES,
+        str(SOLAR_HOUR_ADJUSTMENT),
+        str(DIFFUSE_IRRADIATION_MODEL)
+    ]
+
+
+def morph_epw_file(
+        shared_arguments: tuple[list[str], list[str]],
+        epw_file: Path) -> tuple[Path, int, bool]:
+    """
+    Executes the Future Weather Generator (Morph) for a single EPW file and waits for it to
+    finish. Its standard output is discarded, while its standard error output is logged
+    line by line as soon as it is written.
+
+    Args:
+        shared_arguments (tuple[list[str], list[str]]): Arguments built by
+            build_morph_command, shared by all EPW files.
+        epw_file (Path): Absolute path to the EPW file to be morphed.
+
+    Raises:
+        RuntimeError: If the run was cancelled (see cancel_morph_processes) before the
+        process could be started.
+
+    Returns:
+        tuple[Path, int, bool]: The EPW file processed, the return code of the process and
+        whether it wrote anything to its standard error output.
+    """
+    logging.info(f"Processing file {epw_file.name}")
+    arguments_before_epw, arguments_after_epw = shared_arguments
+    command = [*arguments_before_epw, str(epw_file), *arguments_after_epw]
+    logging.debug(
+        f"Executing FutureWeatherGenerator using the following command:\n"
+        f"{' '.join(command)}")
+
+    start_time = time.perf_counter()
+    has_errors = False
+    with _running_processes_lock:
+        if _cancelled.is_set():
+            raise RuntimeError(f"Processing of '{epw_file.name}' was cancelled")
+        process = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            errors="replace", bufsize=1)
+        _running_processes.add(process)
+    try:
+        with process:
+            for line in process.stderr:
+                has_errors = True
+                logging.error(f"[{epw_file.name}] {line.rstrip()}")
+            returncode = process.wait()
+    finally:
+        with _running_processes_lock:
+            _running_processes.discard(process)
+    logging.info(
+        f"Operation for '{epw_file.name}' completed in "
+        f"{round(time.perf_counter() - start_time)}s with return code {returncode}")
+    return epw_file, returncode, has_errors
+
+
+def cancel_morph_processes() -> None:
+    """
+    Prevents any new Morph process from being started by morph_epw_file and terminates the
+    ones currently running.
+    """
+    with _running_processes_lock:
+        _cancelled.set()
+        for process in _running_processes:
+            process.terminate()
+
+
+def process_epw_files(
+        executor: ThreadPoolExecutor, shared_arguments: tuple[list[str], list[str]],
+        epw_files: list[Path], completed_count: int, total_count: int) -> int:
+    """
+    Submits a job to morph each EPW file to the executor and logs the results as the jobs
+    complete, then returns once all of them are done.
+
+    Args:
+        executor (ThreadPoolExecutor): Executor where the jobs are submitted.
+        shared_arguments (tuple[list[str], list[str]]): Arguments built by
+            build_morph_command, shared by all EPW files.
+        epw_files (list[Path]): Absolute paths to the EPW files to be morphed.
+        completed_count (int): Number of files already processed in previous calls, used
+            in the progress shown in log entries.
+        total_count (int): Total number of files to be processed, used in the progress
+            shown in log entries.
+
+    Returns:
+        int: Number of files processed, including the ones from previous calls.
+    """
+    futures = {
+        executor.submit(morph_epw_file, shared_arguments, epw_file): epw_file
+        for epw_file in epw_files}
+    for future in as_completed(futures):
+        completed_count += 1
+        try:
+            epw_file, returncode, has_errors = future.result()
+        except Exception as e:
+            logging.exception(
+                f"({completed_count}/{total_count}) Could not process "
+                f"'{futures[future].name}'. Details: {str(e)}")
+            continue
+        if has_errors:
+            logging.error(
+                f"({completed_count}/{total_count}) Something went wrong while processing "
+                f"'{epw_file.name}' (return code {returncode}), see details above")
+        else:
+            logging.info(
+                f"({completed_count}/{total_count}) Successfully processed file "
+                f"'{epw_file.name}'")
+    return completed_count
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument as an integer greater than or equal to 1.
+
+    Args:
+        value (str): Value provided in the command line.
+
+    Raises:
+        ArgumentTypeError: If the value is not an integer greater than or equal to 1.
+
+    Returns:
+        int: Parsed value.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(
+            f"must be an integer greater than or equal to 1, got '{value}'")
+    return number
+
+
 def main(args):
     logging.basicConfig(
         format="%(asctime)s    %(levelname)-8.8s: %(message)s",
@@ -63,7 +270,7 @@ def main(args):
         logging.getLogger().setLevel(logging.WARNING)
 
     path_to_jar = Path(args.jar_path)
-    path_to_epw_input = Path(args.epw_path)
+    path_to_epw_input = Path(args.epw_path).resolve()
     epw_file_collection = list_epw_files(path_to_epw_input)
     output_path = Path(path_to_epw_input, "output")
 
@@ -71,49 +278,54 @@ def main(args):
         logging.warning(
             f"This operation might take a few minutes to complete for each file, so your "
             f"wait time for everything to be completed will be significant. Wait times can "
-            f"reach {round(340*len(epw_file_collection)/60)}min, but might be considerably "
-            f"shorter depending on your hardware")
+            f"reach {round(340*len(epw_file_collection)/args.workers/60)}min, but might be "
+            f"considerably shorter depending on your hardware")
         response = input("Continue? (Y/n)\n> ")
         if response.casefold() in {x.casefold() for x in {"no", "n"}}:
             logging.info("Operation cancelled by the user")
             return
 
-    for index, epw_file in enumerate(sorted(epw_file_collection)):
-        logging.info(
-            f"({index+1}/{len(epw_file_collection)}) Processing file {epw_file.name}")
-        command = [
-            "java",
-            "-cp",
-            str(path_to_jar.resolve()),
-            "futureweathergenerator.Morph",
-            str(epw_file.resolve()),
-            ",".join(GCM_MODELS),
-            str(ENSEMBLE),
-            str(MONTH_TRANSITION_HOURS),
-            str(output_path.resolve()) + "/",
-            MULTITHREAD_COMPUTATION,
-            str(INTERPOLATION_METHOD_ID),
-            DO_LIMIT_VARIABLES,
-            str(SOLAR_HOUR_ADJUSTMENT),
-            str(DIFFUSE_IRRADIATION_MODEL)
-        ]
-        logging.debug(
-            f"Executing FutureWeatherGenerator using the following command:\n"
-            f"{' '.join(command)}")
-
-        start_time = time.perf_counter()
-        result = subprocess.run(command, capture_output=True, text=True)
-        logging.info(
-            f"Operation completed in {round(time.perf_counter() - start_time)}s "
-            f"with return code {result.returncode}")
-        if result.stderr:
-            logging.error(
-                f"({index+1}/{len(epw_file_collection)}) Something went wrong while "
-                f"processing '{epw_file.name}', see details:\n{result.stderr}")
-        else:
-            logging.info(
-                f"({index+1}/{len(epw_file_collection)}) Successfully processed file "
-                f"'{epw_file.name}'")
+    # the class data sharing archive is kept in the output directory and, if missing,
+    # created by a single job (so that concurrent JVMs never write it) before the others
+    output_path.mkdir(parents=True, exist_ok=True)
+    cds_archive = Path(output_path.resolve(), f"{path_to_jar.stem}.jsa")
+    temporary_archive = Path(cds_archive.parent, f".{cds_archive.name}.{os.getpid()}.part")
+    java_version = get_java_feature_version()
+    supports_dynamic_cds = (
+        java_version is not None and java_version >= MIN_JAVA_VERSION_FOR_DYNAMIC_CDS)
+    pending_files = sorted(epw_file_collection)
+
+    logging.info(f"Processing files using up to {args.workers} concurrent job(s)")
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        try:
+            completed_count = 0
+            if supports_dynamic_cds and not cds_archive.exists() and len(pending_files) > 1:
+                logging.info(
+                    f"Processing '{pending_files[0].name}' first, to create a class data "
+                    f"sharing archive used by the remaining jobs")
+                completed_count = process_epw_files(
+                    executor,
+                    build_morph_command(
+                        path_to_jar, output_path,
+                        [*JVM_OPTIONS, f"-XX:ArchiveClassesAtExit={temporary_archive}"]),
+                    pending_files[:1], completed_count, len(epw_file_collection))
+                if temporary_archive.exists():
+                    os.replace(temporary_archive, cds_archive)
+                pending_files = pending_files[1:]
+
+            jvm_options = JVM_OPTIONS
+            if supports_dynamic_cds and cds_archive.exists():
+                jvm_options = [*JVM_OPTIONS, f"-XX:SharedArchiveFile={cds_archive}"]
+            process_epw_files(
+                executor, build_morph_command(path_to_jar, output_path, jvm_options),
+                pending_files, completed_count, len(epw_file_collection))
+        except KeyboardInterrupt:
+            logging.warning("Operation interrupted by the user, cancelling remaining files")
+            executor.shutdown(wait=False, cancel_futures=True)
+            cancel_morph_processes()
+            raise
+        finally:
+            temporary_archive.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
@@ -130,4 +342,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "-y", action="store_true", dest="accept_prompts",
         help="consider 'yes' as input for any user prompts")
+    parser.add_argument(
+        "-w", "--workers", type=positive_int, default=max(1, (os.cpu_count() or 1) // 4),
+        help="maximum number of files processed concurrently. Since each job is already "
+        "multithreaded, defaults to a quarter of the available CPUs (at least 1)")
     main(parser.parse_args())
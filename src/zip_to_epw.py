@@ -1,8 +1,23 @@
 #! /usr/bin/env python3.11
 import logging
-from argparse import ArgumentParser
+import os
+import shutil
+import zipfile
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from zipfile import ZipFile, ZipInfo
+from zipfile import BadZipFile, ZipFile, ZipInfo
+
+try:
+    # optional, ISA-L (SIMD) implementation of zlib, used by zipfile when available
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+else:
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+
+COPY_BUFFER_SIZE = 4*1024*1024
 
 
 def list_zip_files(directory: Path) -> list[Path]:
@@ -18,8 +33,10 @@ def list_zip_files(directory: Path) -> list[Path]:
     Returns:
         list[Path]: List of Path objects for each ZIP file found in the directory.
     """
-    zip_file_collection = [
-        file for file in directory.iterdir() if file.suffix.casefold() == ".zip".casefold()]
+    with os.scandir(directory) as entries:
+        zip_file_collection = [
+            Path(entry.path) for entry in entries
+            if entry.name.lower().endswith(".zip") and entry.is_file()]
     if not zip_file_collection:
         logging.warning("No ZIP files found in the selected path")
         raise ValueError("Selected path contains no ZIP files.")
@@ -39,7 +56,84 @@ def zip_member_is_epw_file(member: ZipInfo) -> bool:
     Returns:
         bool: True if extension matches EPW file extension, False otherwise.
     """
-    return member.filename.casefold().endswith(".epw".casefold())
+    return member.filename.lower().endswith(".epw")
+
+
+def extract_epw_files(
+        zip_path: Path, output_path: Path,
+        overwrite: bool = False) -> tuple[list[str], list[str]]:
+    """
+    Extracts all EPW files from a ZIP file into the output directory.
+
+    Members are written directly into the output directory (any directory structure inside
+    the ZIP file is discarded), copying COPY_BUFFER_SIZE bytes at a time. Each member is
+    first extracted to a temporary file in the output directory, which is only published
+    under its final name once complete, so an interrupted extraction never leaves a partial
+    EPW file behind. Unless <overwrite> is set, members whose file name already exists in
+    the output directory (e.g., from a previous run, or extracted from another member or
+    ZIP file with the same name, possibly by another process) are skipped. Where supported
+    by the platform, the kernel is advised to read the ZIP file ahead into the page cache
+    before extraction starts.
+
+    Args:
+        zip_path (Path): Path to the ZIP file.
+        output_path (Path): Directory where the EPW files will be extracted to.
+        overwrite (bool, optional): Whether to replace existing files with the same name.
+            Defaults to False.
+
+    Returns:
+        tuple[list[str], list[str]]: Filenames of the members extracted from the ZIP file
+        and filenames of the members skipped because their target file already existed.
+    """
+    extracted_files = []
+    skipped_files = []
+    with open(zip_path, "rb") as raw_zip, ZipFile(raw_zip, "r") as input_zip:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(raw_zip.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        for member in input_zip.infolist():
+            if not zip_member_is_epw_file(member):
+                continue
+            target_path = Path(output_path, Path(member.filename).name)
+            # unique among concurrent processes, and not matching the EPW extension
+            temporary_path = Path(output_path, f".{target_path.name}.{os.getpid()}.part")
+            try:
+                with input_zip.open(member) as source, open(temporary_path, "wb") as target:
+                    shutil.copyfileobj(source, target, length=COPY_BUFFER_SIZE)
+                if overwrite:
+                    os.replace(temporary_path, target_path)
+                else:
+                    # fails if the target exists, atomically even among concurrent processes
+                    os.link(temporary_path, target_path)
+            except FileExistsError:
+                skipped_files.append(member.filename)
+                continue
+            finally:
+                temporary_path.unlink(missing_ok=True)
+            extracted_files.append(member.filename)
+    return extracted_files, skipped_files
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument as an integer greater than or equal to 1.
+
+    Args:
+        value (str): Value provided in the command line.
+
+    Raises:
+        ArgumentTypeError: If the value is not an integer greater than or equal to 1.
+
+    Returns:
+        int: Parsed value.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(
+            f"must be an integer greater than or equal to 1, got '{value}'")
+    return number
 
 
 def main(args):
@@ -54,24 +148,43 @@ def main(args):
     path_to_zip_input = Path(args.zip_path)
     zip_file_collection = list_zip_files(path_to_zip_input)
     output_path = Path(path_to_zip_input, "epw")
+    output_path.mkdir(exist_ok=True)
 
     total_epw_count = 0
-    for index, zip_path in enumerate(sorted(zip_file_collection)):
-        logging.info(
-            f"({index+1}/{len(zip_file_collection)}) Processing file '{zip_path.name}'")
-        with ZipFile(zip_path, "r") as input_zip:
-            compressed_epw_files = [member for member in filter(
-                zip_member_is_epw_file, input_zip.infolist())]
+    failed_zip_count = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                extract_epw_files, zip_path, output_path, args.overwrite): zip_path
+            for zip_path in sorted(zip_file_collection)}
+        for index, future in enumerate(as_completed(futures)):
+            zip_path = futures[future]
+            try:
+                extracted_files, skipped_files = future.result()
+            except (BadZipFile, OSError) as e:
+                failed_zip_count += 1
+                logging.exception(
+                    f"({index+1}/{len(zip_file_collection)}) Could not extract files from "
+                    f"'{zip_path.name}'. Details: {str(e)}")
+                continue
+            for filename in extracted_files:
+                logging.info(f"Completed the extraction of '{filename}'")
+            for filename in skipped_files:
+                logging.warning(
+                    f"Skipped '{filename}' from '{zip_path.name}', since a file with the "
+                    f"same name already exists in '{output_path.resolve()}' (use "
+                    f"--overwrite to replace it)")
+            total_epw_count += len(extracted_files)
             logging.info(
-                f"Found {len(compressed_epw_files)} compressed EPW file(s) in "
-                f"'{zip_path.name}'")
-            for member in compressed_epw_files:
-                input_zip.extract(member, path=output_path)
-                total_epw_count += 1
-                logging.info(f"Completed the extraction of '{member.filename}'")
+                f"({index+1}/{len(zip_file_collection)}) Extracted "
+                f"{len(extracted_files)} compressed EPW file(s) from '{zip_path.name}'")
     logging.info(
         f"Extracted {total_epw_count} EPW file(s) from ZIP file(s) in "
         f"'{path_to_zip_input.resolve()}' to directory '{output_path.resolve()}'")
+    if failed_zip_count:
+        logging.warning(
+            f"Could not extract files from {failed_zip_count} ZIP file(s), see details "
+            f"above")
 
 
 if __name__ == "__main__":
@@ -82,4 +195,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "-q", "--quiet", action="store_true",
         help="turn on quiet mode, which hides log entries of levels lower than WARNING")
+    parser.add_argument(
+        "-w", "--workers", type=positive_int, default=None,
+        help="maximum number of ZIP files extracted concurrently, each in its own process. "
+        "Defaults to the number of available CPUs")
+    parser.add_argument(
+        "--overwrite", action="store_true",
+        help="replace EPW files that already exist in the output directory (including the "
+        "ones with the same name extracted in the same run), instead of skipping them")
     main(parser.parse_args())